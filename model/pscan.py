@@ -1,155 +1,89 @@
-import math
 import paddle
 import paddle.nn.functional as F
 
-def npo2(len):
-    """
-    Returns the next power of 2 above len
-    """
-    return 2 ** math.ceil(math.log2(len))
+# both sweeps are written out-of-place : each level builds new tensors from the even/odd halves of the previous one,
+# so the whole scan is a plain functional graph (no view + inplace chains) that graph capture can fuse
 
-def pad_npo2(X):
-    """
-    Pads input length dim to the next power of 2
+def _scan(A, X):
+    # A, X : (B, L, D, N)
 
-    Args:
-        X : (B, L, D, N)
+    # H : (B, L, D, N), H[:, t] = A[:, t] * H[:, t-1] + X[:, t]
 
-    Returns:
-        Y : (B, npo2(L), D, N)
-    """
-    len_npo2 = npo2(X.shape[1])
-    pad_tuple = (0, 0, 0, 0, 0, len_npo2 - X.shape[1])
-    return F.pad(X, pad_tuple, mode='constant', value=0)
+    B, L, D, N = A.shape
+    if L == 1:
+        # a copy, never X itself : PScan must not hand its own input back as output (Paddle treats that as inplace)
+        return X.clone()
+    if L % 2 == 1:
+        # odd length : scan the even-length prefix and fold the last element into it (no padding to a power of 2)
+        H = _scan(A[:, :-1], X[:, :-1])
+        return paddle.concat([H, paddle.add(X[:, -1:], paddle.multiply(A[:, -1:], H[:, -1:]))], axis=1)
 
-class PScan(paddle.autograd.PyLayer):
-    @staticmethod
-    def pscan(A, X):
-        B, D, L, _ = A.shape
-        num_steps = int(math.log2(L))
+    Ae, Ao = A[:, 0::2], A[:, 1::2]
+    Xe, Xo = X[:, 0::2], X[:, 1::2]
 
-        Aa = A
-        Xa = X
-        for _ in range(num_steps-2):
-            T = Xa.shape[2]
-            Aa = Aa.reshape([B, D, T//2, 2, -1])
-            Xa = Xa.reshape([B, D, T//2, 2, -1])
+    # up-sweep : combine each (even, odd) pair with (a, b) ⊙ (a', b') = (a·a', a'·b + b') and scan the pairs
+    Ho = _scan(paddle.multiply(Ae, Ao), paddle.add(Xo, paddle.multiply(Ao, Xe))) # states at odd t
 
-            Xa[:, :, :, 1] = paddle.add(Xa[:, :, :, 1], paddle.multiply(Aa[:, :, :, 1], Xa[:, :, :, 0]))
-            Aa[:, :, :, 1] = paddle.multiply(Aa[:, :, :, 0], Aa[:, :, :, 1])
+    # down-sweep : an even t only needs the state right before it
+    He = paddle.concat([Xe[:, :1], paddle.add(Xe[:, 1:], paddle.multiply(Ae[:, 1:], Ho[:, :-1]))], axis=1) # states at even t
 
-            Aa = Aa[:, :, :, 1]
-            Xa = Xa[:, :, :, 1]
+    return paddle.stack([He, Ho], axis=2).reshape([B, L, D, N])
 
-        if Xa.shape[2] == 4:
-            Xa[:, :, 1] = paddle.add(Xa[:, :, 1], paddle.multiply(Aa[:, :, 1], Xa[:, :, 0]))
-            Aa[:, :, 1] = paddle.multiply(Aa[:, :, 0], Aa[:, :, 1])
+def _scan_rev(A, X):
+    # A, X : (B, L, D, N)
 
-            Xa[:, :, 3] = paddle.add(Xa[:, :, 3], paddle.multiply(Aa[:, :, 3], paddle.add(Xa[:, :, 2], paddle.multiply(Aa[:, :, 2], Xa[:, :, 1]))))
-        elif Xa.shape[2] == 2:
-            Xa[:, :, 1] = paddle.add(Xa[:, :, 1], paddle.multiply(Aa[:, :, 1], Xa[:, :, 0]))
-        else:
-            return
+    # H : (B, L, D, N), H[:, t] = A[:, t] * H[:, t+1] + X[:, t]
 
-        Aa = A[:, :, 2**(num_steps-2)-1:L:2**(num_steps-2)]
-        Xa = X[:, :, 2**(num_steps-2)-1:L:2**(num_steps-2)]
-        Xa[:, :, 2] = paddle.add(Xa[:, :, 2], paddle.multiply(Aa[:, :, 2], Xa[:, :, 1]))
-        Aa[:, :, 2] = paddle.multiply(Aa[:, :, 1], Aa[:, :, 2])
+    B, L, D, N = A.shape
+    if L == 1:
+        # a copy, never X itself : PScan must not hand its own input back as output (Paddle treats that as inplace)
+        return X.clone()
+    if L % 2 == 1:
+        # odd length : scan the even-length suffix and fold the first element into it
+        H = _scan_rev(A[:, 1:], X[:, 1:])
+        return paddle.concat([paddle.add(X[:, :1], paddle.multiply(A[:, :1], H[:, :1])), H], axis=1)
 
-        for k in range(num_steps-3, -1, -1):
-            Aa = A[:, :, 2**k-1:L:2**k]
-            Xa = X[:, :, 2**k-1:L:2**k]
+    Ae, Ao = A[:, 0::2], A[:, 1::2]
+    Xe, Xo = X[:, 0::2], X[:, 1::2]
 
-            T = Xa.shape[2]
-            Aa = Aa.reshape([B, D, T//2, 2, -1])
-            Xa = Xa.reshape([B, D, T//2, 2, -1])
+    # mirror of pscan : pairs are combined towards the even element, then the odd states are filled in
+    He = _scan_rev(paddle.multiply(Ae, Ao), paddle.add(Xe, paddle.multiply(Ae, Xo))) # states at even t
+    Ho = paddle.concat([paddle.add(Xo[:, :-1], paddle.multiply(Ao[:, :-1], He[:, 1:])), Xo[:, -1:]], axis=1) # states at odd t
 
-            Xa[:, :, 1:, 0] = paddle.add(Xa[:, :, 1:, 0], paddle.multiply(Aa[:, :, 1:, 0], Xa[:, :, :-1, 1]))
-            Aa[:, :, 1:, 0] = paddle.multiply(Aa[:, :, 1:, 0], Aa[:, :, :-1, 1])
+    return paddle.stack([He, Ho], axis=2).reshape([B, L, D, N])
 
-    @staticmethod
-    def pscan_rev(A, X):
-        B, D, L, _ = A.shape
-        num_steps = int(math.log2(L))
-
-        Aa = A
-        Xa = X
-        for _ in range(num_steps-2):
-            T = Xa.shape[2]
-            Aa = Aa.reshape([B, D, T//2, 2, -1])
-            Xa = Xa.reshape([B, D, T//2, 2, -1])
-            
-            Xa[:, :, :, 0] = paddle.add(Xa[:, :, :, 0], paddle.multiply(Aa[:, :, :, 0], Xa[:, :, :, 1]))
-            Aa[:, :, :, 0] = paddle.multiply(Aa[:, :, :, 1], Aa[:, :, :, 0])
-
-            Aa = Aa[:, :, :, 0]
-            Xa = Xa[:, :, :, 0]
-
-        if Xa.shape[2] == 4:
-            Xa[:, :, 2] = paddle.add(Xa[:, :, 2], paddle.multiply(Aa[:, :, 2], Xa[:, :, 3]))
-            Aa[:, :, 2] = paddle.multiply(Aa[:, :, 3], Aa[:, :, 2])
-
-            Xa[:, :, 0] = paddle.add(Xa[:, :, 0], paddle.multiply(Aa[:, :, 0], paddle.add(Xa[:, :, 1], paddle.multiply(Aa[:, :, 1], Xa[:, :, 2]))))
-        elif Xa.shape[2] == 2:
-            Xa[:, :, 0] = paddle.add(Xa[:, :, 0], paddle.multiply(Aa[:, :, 0], Xa[:, :, 1]))
-        else:
-            return
-
-        Aa = A[:, :, 0:L:2**(num_steps-2)]
-        Xa = X[:, :, 0:L:2**(num_steps-2)]
-        Xa[:, :, 1] = paddle.add(Xa[:, :, 1], paddle.multiply(Aa[:, :, 1], Xa[:, :, 2]))
-        Aa[:, :, 1] = paddle.multiply(Aa[:, :, 2], Aa[:, :, 1])
-
-        for k in range(num_steps-3, -1, -1):
-            Aa = A[:, :, 0:L:2**k]
-            Xa = X[:, :, 0:L:2**k]
-
-            T = Xa.shape[2]
-            Aa = Aa.reshape([B, D, T//2, 2, -1])
-            Xa = Xa.reshape([B, D, T//2, 2, -1])
-
-            Xa[:, :, :-1, 1] = paddle.add(Xa[:, :, :-1, 1], paddle.multiply(Aa[:, :, :-1, 1], Xa[:, :, 1:, 0]))
-            Aa[:, :, :-1, 1] = paddle.multiply(Aa[:, :, 1:, 0], Aa[:, :, :-1, 1])
+# the same sweeps as static programs, traced once per input shape : for a fixed L (as in training) the recursion over the
+# levels is unrolled into one program and replayed without per-level Python dispatch
+_static_scan = paddle.jit.to_static(_scan, full_graph=True)
+_static_scan_rev = paddle.jit.to_static(_scan_rev, full_graph=True)
 
+class PScan(paddle.autograd.PyLayer):
     @staticmethod
-    def forward(ctx, A_in, X_in):
-        L = X_in.shape[1]
-        if L == npo2(L):
-            A = A_in.clone()
-            X = X_in.clone()
-        else:
-            A = pad_npo2(A_in)
-            X = pad_npo2(X_in)
+    def forward(ctx, A_in, X_in, static=False):
+        # static : run the sweeps through their per-shape static programs instead of eagerly
+        # the scan runs directly along the L axis of (B, L, D, N) : no transposed copies in or out
+        # any L is handled without padding, odd lengths are folded in at each level of the scan
+        # every level reads both A and X in lockstep through strided even/odd views : start from dense, identically
+        # strided tensors (a no-op when they already are) rather than letting each level go through strided kernels
+        ctx.static = static
+        scan = _static_scan if static else _scan
+        H = scan(A_in.contiguous(), X_in.contiguous())
 
-        A = A.transpose([0, 2, 1])
-        X = X.transpose([0, 2, 1])
+        ctx.save_for_backward(A_in, H)
 
-        PScan.pscan(A, X)
-
-        ctx.save_for_backward(A_in, X)
-
-        return X.transpose([0, 2, 1])[:, :L]
+        return H
 
     @staticmethod
     def backward(ctx, grad_output_in):
-        A_in, X = ctx.saved_tensor()
-        L = grad_output_in.shape[1]
-
-        if L == npo2(L):
-            grad_output = grad_output_in.clone()
-        else:
-            grad_output = pad_npo2(grad_output_in)
-            A_in = pad_npo2(A_in)
+        A_in, H = ctx.saved_tensor()
 
-        grad_output = grad_output.transpose([0, 2, 1])
-        A_in = A_in.transpose([0, 2, 1])
-        A = paddle.nn.functional.pad(A_in[:, :, 1:], (0, 0, 0, 1))
+        A = F.pad(A_in[:, 1:], (0, 0, 0, 1, 0, 0, 0, 0)) # shift A one step back in time
 
-        PScan.pscan_rev(A, grad_output)
+        scan_rev = _static_scan_rev if ctx.static else _scan_rev
+        grad_output = scan_rev(A, grad_output_in.contiguous())
 
-        Q = paddle.zeros_like(X)
-        Q[:, :, 1:] = paddle.add(Q[:, :, 1:], paddle.multiply(X[:, :, :-1], grad_output[:, :, 1:]))
+        Q = paddle.concat([paddle.zeros_like(H[:, :1]), paddle.multiply(H[:, :-1], grad_output[:, 1:])], axis=1)
 
-        return Q.transpose([0, 2, 1])[:, :L], grad_output.transpose([0, 2, 1])[:, :L]
+        return Q, grad_output
 
 pscan = PScan.apply